@@ -1,72 +1,142 @@
 import streamlit as st
-import pandas as pd
-import time
 import duckdb
 import os
+import re
+import threading
 import atexit
 
 # --- 1. 앱이 실행될 때 DB 파일이 있는지 확인하고, 없으면 생성 ---
 DB_FILE = 'madang.db'
 
+# 쓰기 쿼리가 변경하는 테이블 이름을 찾습니다.
+WRITE_TABLE_PATTERN = re.compile(r"^\s*(?:insert\s+into|update|delete\s+from)\s+(\w+)", re.IGNORECASE)
+
+# 테이블별 원본 CSV 파일과 인덱스
+# (고객명 조회와 주문 JOIN에 쓰이는 컬럼)
+TABLE_SOURCES = {
+    'Customer': ('Customer_madang.csv', [
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_customer_pk ON Customer(custid)",
+        "CREATE INDEX IF NOT EXISTS idx_customer_name ON Customer(name)",
+    ]),
+    'Book': ('Book_madang.csv', []),
+    'Orders': ('Orders_madang.csv', [
+        "CREATE INDEX IF NOT EXISTS idx_orders_custid ON Orders(custid)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_bookid ON Orders(bookid)",
+    ]),
+}
+
 # @st.cache_resource는 DB 연결을 캐시(저장)하여 앱 속도를 높입니다.
 @st.cache_resource
 def get_db_conn():
     """
-    DuckDB에 연결하고, madang.db 파일이 없으면 CSV에서 생성합니다.
+    DuckDB에 연결하고, 없는 테이블이 있으면 CSV에서 생성합니다.
     """
-    db_file_exists = os.path.exists(DB_FILE)
-    
     # DB에 연결합니다 (파일이 없으면 새로 생성됩니다)
-    conn = duckdb.connect(database=DB_FILE, read_only=False)
+    # 이 연결 하나가 앱의 유일한 쓰기 연결이며, 세션이 바뀌어도 cache_resource로 계속 재사용됩니다.
+    conn = duckdb.connect(database=DB_FILE, config={'access_mode': 'READ_WRITE'})
     
-    # 파일이 처음 생성된 경우 (혹은 테이블이 없는 경우)
-    if not db_file_exists:
+    # 파일 존재 여부 대신 DB 카탈로그를 확인하여, 없는 테이블만 만듭니다.
+    # (이전 실행이 생성 도중 중단되었거나 테이블 하나가 삭제된 경우에도 복구됩니다)
+    tables = {r[0] for r in conn.execute("SHOW TABLES").fetchall()}
+    needed = [table for table in TABLE_SOURCES if table not in tables]
+
+    if needed:
         # st.info(...) 메시지는 교수님 요청으로 제거되었습니다.
         
         # CSV 파일로부터 DB 테이블 생성
         try:
-            conn.sql("CREATE TABLE Customer AS SELECT * FROM 'Customer_madang.csv'")
-            conn.sql("CREATE TABLE Book AS SELECT * FROM 'Book_madang.csv'")
-            conn.sql("CREATE TABLE Orders AS SELECT * FROM 'Orders_madang.csv'")
+            conn.execute(f"PRAGMA threads={os.cpu_count() or 1}")
+            conn.execute("PRAGMA temp_directory='/tmp/duckdb'")
+
+            # 필요한 테이블을 하나의 트랜잭션으로 만들고, 마지막에 한 번만 CHECKPOINT 합니다.
+            conn.begin()
+            for table in needed:
+                csv_file, _ = TABLE_SOURCES[table]
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM read_csv_auto('{csv_file}', SAMPLE_SIZE=-1, parallel=true)")
+            conn.commit()
+            conn.execute("CHECKPOINT")
             # st.success(...) 메시지는 교수님 요청으로 제거되었습니다.
         except Exception as e:
             st.error(f"DB 테이블 생성 실패: {e}")
             conn.close()
             st.stop()
 
+    # 인덱스는 이미 있던 테이블(이전 버전에서 만든 madang.db 등)에도 만들어지도록 매번 확인합니다.
+    for _, index_statements in TABLE_SOURCES.values():
+        for index_sql in index_statements:
+            conn.execute(index_sql)
+
+    # 주문번호/고객번호는 max()+1 대신 시퀀스(nextval)로 발급합니다.
+    for seq_name, table, column in (("seq_orderid", "Orders", "orderid"), ("seq_custid", "Customer", "custid")):
+        start = conn.execute(f"SELECT coalesce(max({column}), 0) + 1 FROM {table}").fetchone()[0]
+        conn.execute(f"CREATE SEQUENCE IF NOT EXISTS {seq_name} START {start}")
+
     return conn
 
+# 같은 프로세스에서 같은 DB 파일을 read_only 연결로 한 번 더 열 수는 없으므로,
+# 조회는 공유 연결에서 만든 cursor로 처리합니다.
+# 세션(사용자)마다 자기 cursor를 가지므로 다른 사용자의 조회를 기다리지 않습니다.
+def get_cursor():
+    """
+    현재 세션의 SELECT (읽기) 전용 cursor를 반환합니다.
+    """
+    if '_cur' not in st.session_state:
+        st.session_state['_cur'] = get_db_conn().cursor()
+    return st.session_state['_cur']
+
+# 쓰기 연결은 하나뿐이므로, 쓰기 트랜잭션은 이 잠금으로 한 번에 하나씩 실행합니다.
+@st.cache_resource
+def get_writer_lock():
+    return threading.Lock()
+
 # --- 2. 쿼리 함수 정의 ---
 
-def query_db(sql_query, return_type='dict'):
+def query_db(sql_query, params=None):
     """
-    SELECT (읽기) 쿼리를 실행하고 결과를 반환합니다.
-    캐시된 연결을 사용합니다.
+    SELECT (읽기) 쿼리를 실행하고 결과를 Arrow 테이블로 반환합니다 (st.dataframe 표시용).
+    읽기 전용 cursor를 사용하며, 값은 ? 자리표시자(params)로 전달합니다.
     """
-    conn = get_db_conn()
-    result_data = conn.execute(sql_query)
-    
-    result = None
-    if return_type == 'df':
-        result = result_data.df()
-    elif return_type == 'dict':
-        result = result_data.fetch_df().to_dict('records')
-    else:
-        result = result_data.fetchall()
-    
-    return result
+    # st.dataframe이 Arrow 테이블을 바로 그릴 수 있으므로 pandas 변환 없이 넘깁니다.
+    return get_cursor().execute(sql_query, params).to_arrow_table()
 
-def run_query(sql_query):
+def run_query(sql_query, params=()):
     """
     INSERT/UPDATE (쓰기) 쿼리를 실행합니다.
+    쓰기 잠금을 잡은 상태에서 쓰기 연결로 실행하며, 여러 문장을 [(sql, params), ...]
+    리스트로 넘기면 하나의 트랜잭션으로 묶어서 실행합니다.
+    커밋된 내용은 읽기 cursor의 다음 쿼리부터 바로 보입니다.
     """
-    conn = duckdb.connect(database=DB_FILE, read_only=False)
-    conn.execute(sql_query)
-    conn.close()
-    
-    # 캐시를 지워서 다음번 조회 시 최신 데이터를 반영합니다.
-    st.cache_data.clear()
-    st.cache_resource.clear()
+    statements = sql_query if isinstance(sql_query, list) else [(sql_query, params)]
+
+    conn = get_db_conn()
+    with get_writer_lock():
+        try:
+            conn.begin()
+            for sql, sql_params in statements:
+                conn.execute(sql, sql_params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    # 바뀐 테이블에 해당하는 캐시만 지웁니다.
+    changed_tables = {m.group(1).lower() for sql, _ in statements if (m := WRITE_TABLE_PATTERN.search(sql))}
+    if 'book' in changed_tables:
+        load_books.clear()
+        # session_state는 세션별이므로, 이 쓰기를 실행한 세션의 목록만 지워집니다.
+        st.session_state.pop('books', None)
+    if 'customer' in changed_tables:
+        lookup_custid.clear()
+
+# 고객명으로 custid 찾기 (입력한 이름이 같으면 DB를 다시 조회하지 않습니다)
+@st.cache_data(max_entries=1024)
+def lookup_custid(name):
+    """
+    고객명에 해당하는 custid를 반환합니다. 없으면 None을 반환합니다.
+    Customer 테이블이 바뀌면 run_query에서 캐시를 지웁니다.
+    """
+    row = get_cursor().execute("SELECT custid FROM Customer WHERE name = ? LIMIT 1", [name]).fetchone()
+    return row[0] if row else None
 
 # --- 3. Streamlit 앱 본체 ---
 
@@ -82,16 +152,25 @@ except Exception as e:
 # 도서 목록 불러오기
 @st.cache_data
 def load_books():
-    books = [None]
+    """
+    (bookid, bookname) 쌍의 목록을 반환합니다. 0번째는 '선택 안 함'(None, None)입니다.
+    """
+    books = [(None, None)]
     try:
-        result_list = query_db("select concat(bookid, ',', bookname) as book_info from Book")
-        for res in result_list:
-            books.append(res['book_info'])
+        # pandas를 거치지 않고 Arrow 컬럼에서 바로 Python 리스트로 꺼냅니다.
+        tbl = get_cursor().execute("SELECT bookid, bookname FROM Book").to_arrow_table()
+        books += zip(tbl.column('bookid').to_pylist(), tbl.column('bookname').to_pylist())
     except Exception as e:
         st.error(f"Book 테이블 로드 실패: {e}")
     return books
 
-books = load_books()
+# 도서 목록은 세션마다 처음 한 번만 불러와 session_state에 보관합니다.
+# (재실행마다 cache_data의 해시/조회를 거치지 않기 위함입니다)
+# 이 앱은 Book을 변경하지 않습니다. run_query에서 Book을 변경하더라도 현재 세션의 목록만 지워지며,
+# 다른 세션은 새로 시작할 때까지 기존 목록을 그대로 사용합니다.
+if 'books' not in st.session_state:
+    st.session_state['books'] = load_books()
+book_names_by_id = dict(st.session_state['books'])
 
 # 탭 생성
 tab1, tab2 = st.tabs(["고객조회", "거래 입력"])
@@ -99,82 +178,107 @@ tab1, tab2 = st.tabs(["고객조회", "거래 입력"])
 # --- Tab 1: 고객 조회 ---
 with tab1:
     st.subheader("고객 주문내역 조회")
-    name_input_tab1 = st.text_input("고객명 입력:", key="tab1_name_input")
+    # 폼으로 묶어서 '조회' 버튼을 눌렀을 때만 쿼리를 실행합니다 (타이핑마다 재실행 방지).
+    with st.form("lookup_tab1", clear_on_submit=False):
+        name_input_tab1 = st.text_input("고객명 입력:", key="tab1_name_input")
+        submitted_tab1 = st.form_submit_button("조회")
     
-    if len(name_input_tab1) > 0:
-        cust_data_tab1 = query_db(f"SELECT custid FROM Customer WHERE name = '{name_input_tab1}' LIMIT 1")
+    if submitted_tab1 and name_input_tab1:
+        # 고객 존재 확인과 주문내역 조회를 한 번의 쿼리로 처리합니다.
+        # 고객이 없으면 0행, 주문이 없는 고객이면 orderid(LEFT JOIN 키 쪽 컬럼)가 NULL인 1행이 반환됩니다.
+        sql = """
+            WITH c AS (SELECT custid, name FROM Customer WHERE name = ? LIMIT 1)
+            SELECT c.name, o.orderid, b.bookname, o.orderdate, o.saleprice
+            FROM c LEFT JOIN Orders o USING (custid) LEFT JOIN Book b USING (bookid)
+        """
+        arrow_tbl = query_db(sql, [name_input_tab1])
         
-        if cust_data_tab1:
-            sql = f"select c.custid, c.name, b.bookname, o.orderdate, o.saleprice from Customer c, Book b, Orders o \
-                    where c.custid = o.custid and o.bookid = b.bookid and name = '{name_input_tab1}';"
-            result_data = query_db(sql)
-            
-            if result_data:
-                result_df = pd.DataFrame(result_data)
-                st.dataframe(result_df)
-            else:
-                st.info(f"'{name_input_tab1}' 님은 등록된 고객이지만, 아직 주문 내역이 없습니다.")
-        else:
+        if arrow_tbl.num_rows == 0:
             st.warning(f"'{name_input_tab1}' 고객은 등록되지 않았습니다. '거래 입력' 탭에서 신규 등록할 수 있습니다.")
+        elif arrow_tbl.column('orderid').null_count == arrow_tbl.num_rows:
+            st.info(f"'{name_input_tab1}' 님은 등록된 고객이지만, 아직 주문 내역이 없습니다.")
+        else:
+            st.dataframe(arrow_tbl)
 
 # --- Tab 2: 거래 입력 (교수님 과제 로직) ---
 with tab2:
     st.subheader("신규 거래 입력")
     
-    name_input_tab2 = st.text_input("거래할 고객명:", key="tab2_name_input")
+    with st.form("lookup_tab2", clear_on_submit=False):
+        name_input_tab2 = st.text_input("거래할 고객명:", key="tab2_name_input")
+        submitted_tab2 = st.form_submit_button("조회")
     
-    custid = None
-    is_new_customer = False # 신규 고객인지 확인하는 플래그
+    # 조회 결과는 session_state에 보관하여, 도서/금액 입력 중 재실행될 때 다시 조회하지 않습니다.
+    st.session_state.setdefault("tab2_custid", None)
+    st.session_state.setdefault("tab2_is_new_customer", False) # 신규 고객인지 확인하는 플래그
+    st.session_state.setdefault("tab2_customer_name", "")
 
-    if len(name_input_tab2) > 0:
-        cust_data_tab2 = query_db(f"SELECT custid FROM Customer WHERE name = '{name_input_tab2}' LIMIT 1")
+    if submitted_tab2 and name_input_tab2:
+        # --- [A] 기존 고객인 경우: custid를 찾습니다 ---
+        custid = lookup_custid(name_input_tab2)
         
-        if cust_data_tab2:
-            # --- [A] 기존 고객인 경우 ---
-            custid = cust_data_tab2[0]['custid']
-            
-        else:
-            # --- [B] 신규 고객인 경우 (과제 핵심) ---
-            try:
-                # 1. 새 고객번호(custid) 생성 (max + 1)
-                new_custid_result = query_db("SELECT max(custid) as max_id FROM Customer")
-                new_custid = (new_custid_result[0]['max_id'] or 0) + 1 # max_id가 None일 경우 0으로 처리
-                
-                custid = new_custid
-                is_new_customer = True # 신규 고객 플래그 설정
-                
-                
-            except Exception as e:
-                st.error(f"신규 고객번호 생성 실패: {e}")
-                custid = None # 오류 시 custid를 None으로 되돌림
+        # --- [B] 신규 고객인 경우 (과제 핵심) ---
+        # 새 고객번호(custid)는 INSERT 시점에 seq_custid 시퀀스로 발급됩니다.
+        is_new_customer = custid is None # 신규 고객 플래그 설정
+
+        st.session_state["tab2_custid"] = custid
+        st.session_state["tab2_is_new_customer"] = is_new_customer
+        st.session_state["tab2_customer_name"] = name_input_tab2
+
+    custid = st.session_state["tab2_custid"]
+    is_new_customer = st.session_state["tab2_is_new_customer"]
+    customer_name = st.session_state["tab2_customer_name"]
 
     # 고객이 확인된 경우 (기존이든, 신규든)
-    if custid is not None:
-        select_book = st.selectbox("구매 서적:", books, key="selectbox_books")
+    if custid is not None or is_new_customer:
+        # 거래가 입력될 고객명을 보여줍니다 (입력창을 고친 뒤 '조회'를 누르지 않았을 수 있으므로)
+        # 내용은 거래 입력 처리 후에 채워서, 방금 등록된 고객번호가 바로 보이도록 합니다.
+        customer_caption = st.empty()
+
+        # 선택값은 bookid 자체이며, 화면에는 도서명을 보여줍니다.
+        select_book = st.selectbox(
+            "구매 서적:", list(book_names_by_id), format_func=lambda bid: str(book_names_by_id[bid]), key="selectbox_books"
+        )
         price = st.text_input("금액:", key="price_input")
         
         if st.button('거래 입력', key="submit_button"):
             if select_book is not None and price and price.isdigit():
                 try:
-                    # 1. (신규 고객이라면) Customer 테이블에 먼저 INSERT
-                    if is_new_customer:
-                        # 주소(address)와 전화번호(phone)는 'NULL'로 임의 설정
-                        sql_insert_cust = f"INSERT INTO Customer (custid, name, address, phone) VALUES ({custid}, '{name_input_tab2}', NULL, NULL)"
-                        run_query(sql_insert_cust)
-
-                    # 2. Orders 테이블에 거래 내역 INSERT
-                    bookid = select_book.split(",")[0]
-                    dt = time.strftime('%Y-%m-%d', time.localtime())
-                    
-                    orderid_result = query_db("select max(orderid) as max_id from orders;")
-                    orderid = (orderid_result[0]['max_id'] or 0) + 1 
-                    
-                    sql_insert_order = f"insert into orders (orderid, custid, bookid, saleprice, orderdate) values ({orderid}, {custid}, {bookid}, {price}, '{dt}');"
-                    run_query(sql_insert_order)
+                    bookid = select_book
+
+                    # 신규/기존 여부는 조회 시점의 플래그가 아니라 쓰기 시점의 DB로 판단합니다.
+                    # (다른 세션이 그 사이에 같은 고객을 등록했을 수 있으므로)
+                    statements = [
+                        # 1. 아직 없는 고객이면 Customer 테이블에 먼저 INSERT
+                        #    주소(address)와 전화번호(phone)는 'NULL'로 임의 설정
+                        (
+                            "INSERT INTO Customer (custid, name, address, phone) "
+                            "SELECT nextval('seq_custid'), ?, NULL, NULL "
+                            "WHERE NOT EXISTS (SELECT 1 FROM Customer WHERE name = ?)",
+                            [customer_name, customer_name],
+                        ),
+                        # 2. Orders 테이블에 거래 내역 INSERT (주문번호는 seq_orderid로 발급)
+                        (
+                            "INSERT INTO orders (orderid, custid, bookid, saleprice, orderdate) "
+                            "VALUES (nextval('seq_orderid'), (SELECT custid FROM Customer WHERE name = ? LIMIT 1), ?, ?, CURRENT_DATE)",
+                            [customer_name, bookid, int(price)],
+                        ),
+                    ]
+
+                    # 고객 등록과 주문 입력을 하나의 트랜잭션으로 처리합니다.
+                    run_query(statements)
+
+                    # 이제 등록된 고객이므로 기존 고객으로 표시합니다.
+                    st.session_state["tab2_custid"] = lookup_custid(customer_name)
+                    st.session_state["tab2_is_new_customer"] = False
                     
                     st.success('거래가 입력되었습니다!')
                     
                 except Exception as e:
                     st.error(f"거래 입력 중 오류 발생: {e}")
             else:
-                st.error("구매 서적을 선택하고, 금액을 숫자로 입력해주세요.")
\ No newline at end of file
+                st.error("구매 서적을 선택하고, 금액을 숫자로 입력해주세요.")
+
+        custid = st.session_state["tab2_custid"]
+        is_new_customer = st.session_state["tab2_is_new_customer"]
+        customer_caption.caption(f"고객: {customer_name} ({'신규 등록' if is_new_customer else f'고객번호 {custid}'})")
\ No newline at end of file